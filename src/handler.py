@@ -1,60 +1,258 @@
 # src/handler.py
-import runpod
 import os
+
+# Set up environment variables for HunyuanVideo-Avatar once, before torch initializes CUDA
+os.environ.setdefault('PYTHONPATH', '/workspace')
+os.environ.setdefault('DISABLE_SP', '1')  # Disable multi-GPU processing
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '0')
+# MODEL_BASE is not set here: load_model derives it from STORAGE_BACKEND via resolve_weights_dir()
+
+import runpod
 import sys
+import argparse
+import contextlib
+import csv
+import functools
+import io
+import shutil
+import subprocess
+import threading
+import zipfile
 import torch
 from pathlib import Path
 
 # Add the workspace to Python path
 sys.path.append('/workspace')
 
+# Model weight locations, selected by STORAGE_BACKEND
+CONTAINER_WEIGHTS_DIR = Path("/workspace/HunyuanVideo-Avatar/weights")
+NETWORK_VOLUME_WEIGHTS_DIR = Path("/runpod-volume/weights")
+STORAGE_BACKENDS = ("auto", "container", "network_volume")
+
+# Per-job outputs go under RESULTS_DIR (the image points it at /dev/shm, whose size is set
+# by the container runtime) unless it has too little free space, then under disk
+DISK_RESULTS_DIR = Path("/workspace/results")
+RESULTS_MIN_FREE_BYTES = int(os.environ.get("RESULTS_MIN_FREE_BYTES", 2 * 1024 ** 3))
+
+def _resolve_results_dir():
+    """Use RESULTS_DIR if it has room for a job's output, otherwise fall back to disk"""
+    results_dir = Path(os.environ.get("RESULTS_DIR", str(DISK_RESULTS_DIR)))
+    if results_dir == DISK_RESULTS_DIR:
+        return results_dir
+    
+    try:
+        results_dir.mkdir(parents=True, exist_ok=True)
+        free_bytes = shutil.disk_usage(results_dir).free
+    except OSError as e:
+        print(f"⚠️ Cannot use {results_dir} for results ({e}); using {DISK_RESULTS_DIR}")
+        return DISK_RESULTS_DIR
+    
+    if free_bytes < RESULTS_MIN_FREE_BYTES:
+        print(f"⚠️ Only {free_bytes // 1024 ** 2} MiB free in {results_dir}; using {DISK_RESULTS_DIR} for results")
+        return DISK_RESULTS_DIR
+    return results_dir
+
+RESULTS_DIR = _resolve_results_dir()
+
+# sample_gpu_poor.py options that are the same for every job
+_STATIC_ARGS = ("--use-deepcache", "1", "--flow-shift-eval-video", "5.0", "--infer-min")
+
+# HunyuanVideo-Avatar pipeline, kept resident in VRAM across jobs
+_PIPELINE = None
+_PIPELINE_LOCK = threading.Lock()
+
+# Reason the startup load failed, returned to jobs instead of reloading each time
+_LOAD_ERROR = None
+
+@functools.lru_cache(maxsize=32)
+def _parse_resolution(resolution):
+    """Return the image size for a "WIDTHxHEIGHT" resolution string"""
+    if "x" in resolution:
+        width, height = map(int, resolution.split("x"))
+        return max(width, height)  # Use the larger dimension
+    return 704  # Default size
+
+@contextlib.contextmanager
+def _mmap_torch_load(ckpt):
+    """Make torch.load memory-map the transformer checkpoint instead of copying it into RAM"""
+    original_load = torch.load
+    ckpt_path = os.path.realpath(ckpt)
+    
+    def load(f, *args, **kwargs):
+        # mmap=True only works for zipfile-format checkpoints given by path; leave other loads alone
+        if (isinstance(f, (str, os.PathLike)) and "mmap" not in kwargs
+                and os.path.realpath(f) == ckpt_path and zipfile.is_zipfile(f)):
+            kwargs["mmap"] = True
+        return original_load(f, *args, **kwargs)
+    
+    torch.load = load
+    try:
+        yield
+    finally:
+        torch.load = original_load
+
+def init_pipeline(ckpt, use_fp8=True):
+    """Build the HunyuanVideo-Avatar sampler and its audio/face helpers once"""
+    # Import HunyuanVideo-Avatar modules (MODEL_BASE must be set beforehand)
+    from hymm_sp.config import add_extra_args, sanity_check_args
+    from hymm_sp.sample_inference_audio import HunyuanVideoSampler
+    from hymm_sp.data_kits.face_align import AlignImage
+    from transformers import WhisperModel, AutoFeatureExtractor
+    
+    print(f"🔧 Initializing HunyuanVideo-Avatar pipeline from {ckpt}...")
+    
+    # Parse the static sample_gpu_poor.py options once; per-job values are overlaid later
+    parser = add_extra_args(argparse.ArgumentParser(description="HunyuanVideo-Avatar RunPod worker"))
+    argv = ["--ckpt", ckpt, *_STATIC_ARGS]
+    if use_fp8:
+        argv.append("--use-fp8")
+    args = sanity_check_args(parser.parse_args(argv))
+    
+    model_base = os.environ['MODEL_BASE']
+    device = torch.device("cuda")
+    
+    # Jobs at the same resolution reuse the same shapes, so let cuDNN pick the fastest kernels
+    torch.backends.cudnn.benchmark = True
+    
+    with _mmap_torch_load(ckpt):
+        sampler = HunyuanVideoSampler.from_pretrained(ckpt, args=args)
+    
+    # Optionally JIT-compile the transformer; the compile cost is paid on the first job
+    if os.environ.get("TORCH_COMPILE", "0") == "1" and hasattr(torch, "compile"):
+        print("⚙️ Compiling transformer with torch.compile...")
+        sampler.pipeline.transformer = torch.compile(sampler.pipeline.transformer, mode="reduce-overhead")
+    
+    wav2vec = WhisperModel.from_pretrained(f"{model_base}/ckpts/whisper-tiny/")
+    wav2vec = wav2vec.to(device=device, dtype=torch.float32)
+    wav2vec.requires_grad_(False)
+    feature_extractor = AutoFeatureExtractor.from_pretrained(f"{model_base}/ckpts/whisper-tiny/")
+    align_instance = AlignImage("cuda", det_path=f"{model_base}/ckpts/det_align/detface.pt")
+    
+    print("✅ Pipeline ready!")
+    return {
+        "sampler": sampler,
+        "args": sampler.args,
+        "wav2vec": wav2vec,
+        "feature_extractor": feature_extractor,
+        "align_instance": align_instance
+    }
+
+def get_pipeline(ckpt):
+    """Return the cached pipeline, initializing it on first use"""
+    global _PIPELINE
+    if _PIPELINE is None:
+        with _PIPELINE_LOCK:
+            if _PIPELINE is None:
+                _PIPELINE = init_pipeline(ckpt)
+    return _PIPELINE
+
+def run_pipeline(pipeline, args):
+    """Run sample_gpu_poor.py's sampling loop in-process against a cached pipeline"""
+    import numpy as np
+    import imageio
+    from einops import rearrange
+    from torch.utils.data import DataLoader
+    from hymm_sp.data_kits.audio_dataset import VideoAudioTextLoaderVal
+    
+    sampler = pipeline["sampler"]
+    video_dataset = VideoAudioTextLoaderVal(
+        image_size=args.image_size,
+        meta_file=args.input,
+        text_encoder=sampler.text_encoder,
+        text_encoder_2=sampler.text_encoder_2,
+        feature_extractor=pipeline["feature_extractor"]
+    )
+    json_loader = DataLoader(video_dataset, batch_size=1, shuffle=False, drop_last=False)
+    
+    for batch in json_loader:
+        videoid = batch["videoid"][0]
+        audio_path = str(batch["audio_path"][0])
+        output_path = f"{args.save_path}/{videoid}.mp4"
+        output_audio_path = f"{args.save_path}/{videoid}_audio.mp4"
+        
+        with torch.inference_mode():
+            samples = sampler.predict(
+                args, batch,
+                pipeline["wav2vec"],
+                pipeline["feature_extractor"],
+                pipeline["align_instance"]
+            )
+        
+        # Denoised latent, (bs, 16, t//4, h//8, w//8), trimmed to the audio length
+        sample = samples["samples"][0].unsqueeze(0)
+        sample = sample[:, :, :batch["audio_len"][0]]
+        video = rearrange(sample[0], "c f h w -> f h w c")
+        video = (video * 255.).data.cpu().numpy().astype(np.uint8)
+        torch.cuda.empty_cache()
+        
+        imageio.mimsave(output_path, np.stack(list(video), axis=0), fps=batch["fps"].item())
+        
+        # Mux the driving audio into the final video
+        subprocess.run([
+            "ffmpeg", "-i", output_path, "-i", audio_path,
+            "-shortest", output_audio_path, "-y", "-loglevel", "quiet"
+        ], check=True)
+        os.remove(output_path)
+
+def _download_weights(weights_dir):
+    """Download the HunyuanVideo-Avatar checkpoints from Hugging Face"""
+    print(f"📥 Models not found. Downloading to {weights_dir}...")
+    weights_dir.mkdir(parents=True, exist_ok=True)
+    
+    # Configure high-throughput transfers before huggingface_hub is imported
+    os.environ["HF_XET_HIGH_PERFORMANCE"] = "1"
+    os.environ["HF_XET_NUM_CONCURRENT_RANGE_GETS"] = "64"
+    os.environ["HF_XET_CHUNK_CACHE_SIZE_BYTES"] = "0"
+    os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = "1"
+    from huggingface_hub import snapshot_download
+    
+    print("🔄 Starting model download (this may take 10-60 minutes)...")
+    
+    # Fetch files concurrently, skipping anything outside the checkpoints and the unused
+    # bf16 transformer (same file set as the Dockerfile bakes in)
+    snapshot_download(
+        repo_id="tencent/HunyuanVideo-Avatar",
+        local_dir=str(weights_dir),
+        max_workers=16,
+        allow_patterns=["ckpts/*", "*.json", "*.txt"],
+        ignore_patterns=["*/transformers/mp_rank_00_model_states.pt"]
+    )
+    
+    print("✅ Model download completed!")
+
+def resolve_weights_dir():
+    """
+    Pick the weights directory for STORAGE_BACKEND (auto, container or network_volume)
+    """
+    backend = os.environ.get("STORAGE_BACKEND", "auto")
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown STORAGE_BACKEND '{backend}', expected one of {', '.join(STORAGE_BACKENDS)}")
+    
+    # In auto mode prefer weights baked into the container, then the RunPod network volume
+    if backend in ("auto", "container") and (CONTAINER_WEIGHTS_DIR / "ckpts").exists():
+        print(f"✅ Using models from container: {CONTAINER_WEIGHTS_DIR}")
+        return CONTAINER_WEIGHTS_DIR
+    if backend in ("auto", "network_volume") and (NETWORK_VOLUME_WEIGHTS_DIR / "ckpts").exists():
+        print(f"✅ Using models from RunPod network volume: {NETWORK_VOLUME_WEIGHTS_DIR}")
+        return NETWORK_VOLUME_WEIGHTS_DIR
+    
+    if os.environ.get("ALLOW_RUNTIME_DOWNLOAD", "0") != "1":
+        raise FileNotFoundError(
+            f"Model weights not found for STORAGE_BACKEND '{backend}' "
+            "(set ALLOW_RUNTIME_DOWNLOAD=1 to download them at startup)"
+        )
+    
+    weights_dir = CONTAINER_WEIGHTS_DIR if backend == "container" else NETWORK_VOLUME_WEIGHTS_DIR
+    _download_weights(weights_dir)
+    return weights_dir
+
 def load_model():
     """Load the HunyuanVideo-Avatar model"""
+    global _LOAD_ERROR
     try:
         print("Loading HunyuanVideo-Avatar model...")
         
-        # Check for models in RunPod network volume first, then fallback to container
-        network_volume_dir = Path("/runpod-volume/weights")
-        container_weights_dir = Path("/workspace/HunyuanVideo-Avatar/weights")
-        
-        # Determine which weights directory to use
-        if network_volume_dir.exists() and (network_volume_dir / "ckpts").exists():
-            weights_dir = network_volume_dir
-            print(f"✅ Using models from RunPod network volume: {weights_dir}")
-        elif container_weights_dir.exists() and (container_weights_dir / "ckpts").exists():
-            weights_dir = container_weights_dir
-            print(f"✅ Using models from container: {weights_dir}")
-        else:
-            # Download models to network volume
-            print("📥 Models not found. Downloading to RunPod network volume...")
-            weights_dir = network_volume_dir
-            weights_dir.mkdir(parents=True, exist_ok=True)
-            
-            # Download models with progress monitoring
-            import subprocess
-            import sys
-            
-            print("🔄 Starting model download (this may take 10-60 minutes)...")
-            print("📊 Download progress will be shown below:")
-            
-            # Run huggingface-cli download with progress
-            process = subprocess.Popen([
-                "huggingface-cli", "download", 
-                "tencent/HunyuanVideo-Avatar", 
-                "--local-dir", str(weights_dir)
-            ], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-            
-            # Stream the output in real-time
-            for line in process.stdout:
-                print(f"📥 {line.strip()}")
-                sys.stdout.flush()
-            
-            process.wait()
-            
-            if process.returncode != 0:
-                raise Exception("Model download failed")
-            
-            print("✅ Model download completed!")
+        weights_dir = resolve_weights_dir()
         
         # Check for key model files
         ckpts_dir = weights_dir / "ckpts"
@@ -62,37 +260,50 @@ def load_model():
             raise FileNotFoundError("Model checkpoints not found in weights/ckpts/")
         
         print(f"✅ Models found in: {weights_dir}")
+        os.environ['MODEL_BASE'] = str(weights_dir)
         print(f"📁 Available model directories:")
         for item in ckpts_dir.iterdir():
             if item.is_dir():
                 print(f"  - {item.name}")
         
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        print(f"🚀 Using device: {device}")
-        
-        # Import HunyuanVideo-Avatar modules
-        from models.hunyuan_video_avatar import HunyuanVideoAvatar
-        from configs.config import get_config
-        
-        # Load configuration
-        config = get_config()
-        config.device = device
+        # The pipeline runs on CUDA only, so fail before building it on a GPU-less worker
+        if not torch.cuda.is_available():
+            raise RuntimeError("CUDA is not available; HunyuanVideo-Avatar requires a GPU")
+        print(f"🚀 Using device: {torch.cuda.get_device_name(0)}")
         
-        # Initialize model
-        model = HunyuanVideoAvatar(config)
-        model.to(device)
-        model.eval()
+        # Build the pipeline once; it stays resident for the life of the worker
+        checkpoint_path = ckpts_dir / "hunyuan-video-t2v-720p/transformers/mp_rank_00_model_states_fp8.pt"
+        model = get_pipeline(str(checkpoint_path))
         
         print("✅ Model loaded successfully!")
         return model
         
     except Exception as e:
+        _LOAD_ERROR = f"{type(e).__name__}: {e}"
         print(f"❌ Error loading model: {e}")
         return None
 
-def generate_video(job):
+def _prune_results():
+    """Remove earlier jobs' output directories so RESULTS_DIR usage stays bounded"""
+    if not RESULTS_DIR.exists():
+        return
+    with os.scandir(RESULTS_DIR) as entries:
+        for entry in entries:
+            if entry.name.startswith("job_") and entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+def _ensure_model():
+    """Return the resident pipeline, loading it once if startup did not run"""
+    if _PIPELINE is None and _LOAD_ERROR is None:
+        load_model()
+    if _PIPELINE is None:
+        # Don't retry a failed load on every job; report why it failed instead
+        raise RuntimeError(f"HunyuanVideo-Avatar model failed to load: {_LOAD_ERROR}")
+    return _PIPELINE
+
+def generate_video(job, model=None):
     """
-    Generate video based on the job input using HunyuanVideo-Avatar
+    Generate video based on the job input using a loaded HunyuanVideo-Avatar pipeline
     """
     job_input = job["input"]
     
@@ -106,51 +317,37 @@ def generate_video(job):
     infer_steps = job_input.get("infer_steps", 50)
     
     try:
-        # Set up environment variables for HunyuanVideo-Avatar
-        os.environ['PYTHONPATH'] = '/workspace'
-        os.environ['MODEL_BASE'] = '/runpod-volume/weights'
-        os.environ['DISABLE_SP'] = '1'  # Disable multi-GPU processing
-        os.environ['CUDA_VISIBLE_DEVICES'] = '0'
+        # Only the latest job's output is kept; clear earlier ones before writing
+        _prune_results()
         
         # Create output directory
-        output_dir = f"/workspace/results/job_{job['id']}"
-        os.makedirs(output_dir, exist_ok=True)
+        output_dir = RESULTS_DIR / f"job_{job['id']}"
+        output_dir.mkdir(parents=True, exist_ok=True)
         
         # Create input CSV file for HunyuanVideo-Avatar
-        csv_path = f"{output_dir}/input.csv"
-        with open(csv_path, 'w') as f:
-            f.write("prompt,seed\n")
-            f.write(f'"{prompt}",{seed}\n')
-        
-        # Determine checkpoint path
-        checkpoint_path = "/runpod-volume/weights/ckpts/hunyuan-video-t2v-720p/transformers/mp_rank_00_model_states_fp8.pt"
+        csv_path = output_dir / "input.csv"
+        csv_buffer = io.StringIO()
+        writer = csv.writer(csv_buffer, lineterminator="\n")
+        writer.writerow(["prompt", "seed"])
+        writer.writerow([prompt, seed])
+        csv_path.write_bytes(csv_buffer.getvalue().encode("utf-8"))
         
         # Calculate frames based on duration and fps
         sample_n_frames = int(duration * fps)
         
         # Parse resolution
-        if "x" in resolution:
-            width, height = map(int, resolution.split("x"))
-            image_size = max(width, height)  # Use the larger dimension
-        else:
-            image_size = 704  # Default size
-        
-        # Build the command arguments
-        cmd_args = [
-            "python3", "hymm_sp/sample_gpu_poor.py",
-            "--input", csv_path,
-            "--ckpt", checkpoint_path,
-            "--sample-n-frames", str(sample_n_frames),
-            "--seed", str(seed),
-            "--image-size", str(image_size),
-            "--cfg-scale", str(cfg_scale),
-            "--infer-steps", str(infer_steps),
-            "--use-deepcache", "1",
-            "--flow-shift-eval-video", "5.0",
-            "--save-path", output_dir,
-            "--use-fp8",
-            "--infer-min"
-        ]
+        image_size = _parse_resolution(resolution)
+        
+        # Per-job overrides on top of the pipeline's static arguments
+        job_args = {
+            "input": str(csv_path),
+            "sample_n_frames": sample_n_frames,
+            "seed": seed,
+            "image_size": image_size,
+            "cfg_scale": cfg_scale,
+            "infer_steps": infer_steps,
+            "save_path": str(output_dir)
+        }
         
         print(f"🎬 Starting video generation with parameters:")
         print(f"   Prompt: {prompt}")
@@ -161,35 +358,22 @@ def generate_video(job):
         print(f"   Image Size: {image_size}")
         print(f"   Output Dir: {output_dir}")
         
-        # Execute the HunyuanVideo-Avatar inference
-        import subprocess
-        import sys
-        
+        # Execute the HunyuanVideo-Avatar inference in-process
         print("🚀 Executing HunyuanVideo-Avatar inference...")
-        process = subprocess.Popen(
-            cmd_args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            cwd="/workspace"
-        )
-        
-        # Stream the output in real-time
-        for line in process.stdout:
-            print(f"📹 {line.strip()}")
-            sys.stdout.flush()
-        
-        process.wait()
-        
-        if process.returncode != 0:
-            raise Exception(f"HunyuanVideo-Avatar inference failed with return code {process.returncode}")
+        if model is None:
+            raise RuntimeError("HunyuanVideo-Avatar model is not loaded")
+        args = argparse.Namespace(**{**vars(model["args"]), **job_args})
+        run_pipeline(model, args)
         
         # Find the generated video file
-        video_files = list(Path(output_dir).glob("*.mp4"))
-        if not video_files:
+        with os.scandir(output_dir) as entries:
+            output_video = next(
+                (Path(e.path) for e in entries if e.name.endswith(".mp4") and e.is_file()),
+                None
+            )
+        if output_video is None:
             raise FileNotFoundError(f"No video files found in {output_dir}")
         
-        output_video = video_files[0]
         print(f"✅ Video generated successfully: {output_video}")
         
         # Return the result
@@ -221,13 +405,18 @@ def handler(job):
     RunPod handler function
     """
     try:
-        # Process the job directly using HunyuanVideo-Avatar script
-        result = generate_video(job)
+        # Process the job with the resident HunyuanVideo-Avatar pipeline
+        result = generate_video(job, _ensure_model())
         return result
         
     except Exception as e:
         return {"error": f"Handler error: {str(e)}"}
 
 if __name__ == "__main__":
+    # Load the model before accepting jobs so the first request runs warm;
+    # exit on failure so RunPod replaces the worker instead of serving errors
+    if load_model() is None:
+        sys.exit(f"❌ Worker startup failed: {_LOAD_ERROR}")
+    
     # Start the RunPod serverless handler
     runpod.serverless.start({"handler": handler})
\ No newline at end of file